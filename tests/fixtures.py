@@ -63,8 +63,7 @@ def directory(request, test_base_dir, test_name):
         test_base_dir, "{}_{}".format(test_name, ATTEMPTS[test_name])
     )
 
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    os.makedirs(directory, exist_ok=True)
 
     yield directory
 
@@ -48,8 +48,7 @@ class Bitcoind(TailableProc):
         self.prefix = "bitcoind"
 
         regtestdir = os.path.join(bitcoin_dir, "regtest")
-        if not os.path.exists(regtestdir):
-            os.makedirs(regtestdir)
+        os.makedirs(regtestdir, exist_ok=True)
 
         self.cmd_line = [
             BITCOIND_PATH,
@@ -102,9 +101,7 @@ class Bitcoind(TailableProc):
                 wait_for_mempool = [wait_for_mempool]
             if isinstance(wait_for_mempool, list):
                 wait_for(
-                    lambda: all(
-                        txid in self.rpc.getrawmempool() for txid in wait_for_mempool
-                    )
+                    lambda: set(wait_for_mempool).issubset(self.rpc.getrawmempool())
                 )
             else:
                 wait_for(lambda: len(self.rpc.getrawmempool()) >= wait_for_mempool)
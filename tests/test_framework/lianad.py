@@ -14,6 +14,7 @@ from test_framework.utils import (
 )
 from test_framework.serializations import (
     PSBT,
+    deser_der_path,
     CTxInWitness,
     CScriptWitness,
     PSBT_IN_BIP32_DERIVATION,
@@ -39,6 +40,10 @@ class Lianad(TailableProc):
         self.signer = signer
         self.multi_desc = multi_desc
         self.receive_desc, self.change_desc = multi_desc.singlepath_descriptors()
+        # Descriptors are derived in place, so we need fresh copies to derive them at a
+        # given index. Only render them once for this purpose.
+        self.receive_desc_str = str(self.receive_desc)
+        self.change_desc_str = str(self.change_desc)
 
         self.conf_file = os.path.join(datadir, "config.toml")
         self.cmd_line = [LIANAD_PATH, "--conf", f"{self.conf_file}"]
@@ -46,19 +51,18 @@ class Lianad(TailableProc):
         self.rpc = UnixDomainSocketRpc(socket_path)
 
         with open(self.conf_file, "w") as f:
-            f.write(f"data_dir = '{datadir}'\n")
-            f.write("daemon = false\n")
-            f.write(f"log_level = '{LOG_LEVEL}'\n")
-
-            f.write(f'main_descriptor = "{multi_desc}"\n')
-
-            f.write("[bitcoin_config]\n")
-            f.write('network = "regtest"\n')
-            f.write("poll_interval_secs = 1\n")
-
-            f.write("[bitcoind_config]\n")
-            f.write(f"cookie_path = '{bitcoind_cookie_path}'\n")
-            f.write(f"addr = '127.0.0.1:{bitcoind_rpc_port}'\n")
+            f.write(
+                f"data_dir = '{datadir}'\n"
+                "daemon = false\n"
+                f"log_level = '{LOG_LEVEL}'\n"
+                f'main_descriptor = "{multi_desc}"\n'
+                "[bitcoin_config]\n"
+                'network = "regtest"\n'
+                "poll_interval_secs = 1\n"
+                "[bitcoind_config]\n"
+                f"cookie_path = '{bitcoind_cookie_path}'\n"
+                f"addr = '127.0.0.1:{bitcoind_rpc_port}'\n"
+            )
 
     def finalize_psbt(self, psbt):
         """Create a valid witness for all inputs in the PSBT.
@@ -69,24 +73,29 @@ class Lianad(TailableProc):
         """
         assert isinstance(psbt, PSBT)
 
+        # Inputs spending coins at the same derivation path share the same derived
+        # descriptor. Parse and derive it only once for all of them.
+        derived_descs = {}
+
         # Create a witness for each input of the transaction.
+        psbt.tx.wit.vtxinwit = [None] * len(psbt.i)
         for i, psbt_in in enumerate(psbt.i):
             # First, gather the needed information from the PSBT input.
             # 'hd_keypaths' is of the form {pubkey: (fingerprint, derivation index)}
             fing_der = next(iter(psbt_in.map[PSBT_IN_BIP32_DERIVATION].values()))
             raw_der_path = fing_der[4:]
-            der_path = [
-                int.from_bytes(raw_der_path[i : i + 4], byteorder="little", signed=True)
-                for i in range(0, len(raw_der_path), 4)
-            ]
+            der_path = deser_der_path(raw_der_path)
             assert len(der_path) == 2
 
             # Create a copy of the descriptor to derive it at the index used in this input.
             # Then create a satisfaction for it using the signature we just created.
-            desc = Descriptor.from_str(
-                str(self.receive_desc if der_path[0] == 0 else self.change_desc)
-            )
-            desc.derive(der_path[1])
+            desc = derived_descs.get(tuple(der_path))
+            if desc is None:
+                desc = Descriptor.from_str(
+                    self.receive_desc_str if der_path[0] == 0 else self.change_desc_str
+                )
+                desc.derive(der_path[1])
+                derived_descs[tuple(der_path)] = desc
             sat_material = SatisfactionMaterial(
                 signatures=psbt_in.map[PSBT_IN_PARTIAL_SIG],
             )
@@ -98,7 +107,7 @@ class Lianad(TailableProc):
             psbt_in.map[PSBT_IN_FINAL_SCRIPTWITNESS] = CTxInWitness(
                 CScriptWitness(stack)
             )
-            psbt.tx.wit.vtxinwit.append(psbt_in.map[PSBT_IN_FINAL_SCRIPTWITNESS])
+            psbt.tx.wit.vtxinwit[i] = psbt_in.map[PSBT_IN_FINAL_SCRIPTWITNESS]
 
         return psbt
 
@@ -132,6 +141,7 @@ class Lianad(TailableProc):
             self.proc.wait(timeout)
         except Exception as e:
             logging.error(f"{self.prefix} : error when calling stop: '{e}'")
+        self.rpc.close()
         return TailableProc.stop(self)
 
     def cleanup(self):
@@ -22,16 +22,25 @@ ser_*, deser_*: functions that handle serialization/deserialization
 """
 
 from io import BytesIO
-from codecs import encode
 import struct
 import binascii
 import hashlib
-import copy
 import base64
 
+# Precompiled packers for the fixed-size fields, to avoid parsing the format at each call.
+_S_U8 = struct.Struct("<B")
+_S_U16 = struct.Struct("<H")
+_S_I32 = struct.Struct("<i")
+_S_U32 = struct.Struct("<I")
+_S_I64 = struct.Struct("<q")
+_S_U64 = struct.Struct("<Q")
+_S_COMPACT_BH = struct.Struct("<BH")
+_S_COMPACT_BI = struct.Struct("<BI")
+_S_COMPACT_BQ = struct.Struct("<BQ")
+
 
 def sha256(s):
-    return hashlib.new("sha256", s).digest()
+    return hashlib.sha256(s).digest()
 
 
 def ripemd160(s):
@@ -39,7 +48,7 @@ def ripemd160(s):
 
 
 def hash256(s):
-    return sha256(sha256(s))
+    return hashlib.sha256(hashlib.sha256(s).digest()).digest()
 
 
 def hash160(s):
@@ -47,30 +56,46 @@ def hash160(s):
 
 
 # Serialization/deserialization tools
+# The single-byte compact sizes, which are the vast majority of them.
+_SMALL_COMPACT_SIZES = [bytes([i]) for i in range(253)]
+
+
 def ser_compact_size(l):
-    r = b""
     if l < 253:
-        r = struct.pack("B", l)
+        return _SMALL_COMPACT_SIZES[l]
     elif l < 0x10000:
-        r = struct.pack("<BH", 253, l)
+        return _S_COMPACT_BH.pack(253, l)
     elif l < 0x100000000:
-        r = struct.pack("<BI", 254, l)
-    else:
-        r = struct.pack("<BQ", 255, l)
-    return r
+        return _S_COMPACT_BI.pack(254, l)
+    return _S_COMPACT_BQ.pack(255, l)
 
 
 def deser_compact_size(f):
-    nit = struct.unpack("<B", f.read(1))[0]
+    nit = f.read(1)[0]
     if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
+        nit = _S_U16.unpack(f.read(2))[0]
     elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
+        nit = _S_U32.unpack(f.read(4))[0]
     elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
+        nit = _S_U64.unpack(f.read(8))[0]
     return nit
 
 
+def parse_compact_size(buf, off):
+    """Parse a compact size from {buf} at offset {off}, without copying.
+
+    :returns: the size and the offset right after it.
+    """
+    nit = buf[off]
+    if nit < 253:
+        return nit, off + 1
+    if nit == 253:
+        return _S_U16.unpack_from(buf, off + 1)[0], off + 3
+    if nit == 254:
+        return _S_U32.unpack_from(buf, off + 1)[0], off + 5
+    return _S_U64.unpack_from(buf, off + 1)[0], off + 9
+
+
 def deser_string(f):
     nit = deser_compact_size(f)
     return f.read(nit)
@@ -81,27 +106,15 @@ def ser_string(s):
 
 
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return int.from_bytes(f.read(32), "little")
 
 
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return u.to_bytes(32, "little")
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    return int.from_bytes(s[:32], "little")
 
 
 def uint256_from_compact(c):
@@ -123,14 +136,17 @@ def deser_vector(f, c):
 # ser_function_name: Allow for an alternate serialization function on the
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
-def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
+# buf: if given, the serialization is appended to this bytearray (which is returned)
+# instead of being returned as a new bytes object.
+def ser_vector(l, ser_function_name=None, buf=None):
+    r = bytearray() if buf is None else buf
+    r += ser_compact_size(len(l))
     for i in l:
         if ser_function_name:
             r += getattr(i, ser_function_name)()
         else:
             r += i.serialize()
-    return r
+    return bytes(r) if buf is None else r
 
 
 def deser_uint256_vector(f):
@@ -143,10 +159,10 @@ def deser_uint256_vector(f):
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for i in l:
         r += ser_uint256(i)
-    return r
+    return bytes(r)
 
 
 def deser_string_vector(f):
@@ -159,26 +175,38 @@ def deser_string_vector(f):
 
 
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for sv in l:
         r += ser_string(sv)
-    return r
+    return bytes(r)
 
 
 def deser_int_vector(f):
     nit = deser_compact_size(f)
     r = []
     for i in range(nit):
-        t = struct.unpack("<i", f.read(4))[0]
+        t = _S_I32.unpack(f.read(4))[0]
         r.append(t)
     return r
 
 
 def ser_int_vector(l):
-    r = ser_compact_size(len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for i in l:
-        r += struct.pack("<i", i)
-    return r
+        r += _S_I32.pack(i)
+    return bytes(r)
+
+
+# Packers for derivation paths, by number of child indexes.
+_S_DER_PATHS = {}
+
+
+def deser_der_path(s):
+    """Deserialize a BIP32 derivation path, a sequence of uint32 child indexes."""
+    n = len(s) // 4
+    if n not in _S_DER_PATHS:
+        _S_DER_PATHS[n] = struct.Struct(f"<{n}I")
+    return list(_S_DER_PATHS[n].unpack(s))
 
 
 def hex_str_to_bytes(s):
@@ -232,16 +260,16 @@ def ser_sig_der(r, s):
 
     # Write total length
     total_len = len(r) + len(s) + 4
-    sig += struct.pack("B", total_len)
+    sig += _S_U8.pack(total_len)
 
     # write r
     sig += b"\x02"
-    sig += struct.pack("B", len(r))
+    sig += _S_U8.pack(len(r))
     sig += r
 
     # write s
     sig += b"\x02"
-    sig += struct.pack("B", len(s))
+    sig += _S_U8.pack(len(s))
     sig += s
 
     sig += b"\x01"
@@ -249,8 +277,8 @@ def ser_sig_der(r, s):
 
 
 def ser_sig_compact(r, s, recid):
-    rec = struct.unpack("B", recid)[0]
-    prefix = struct.pack("B", 27 + 4 + rec)
+    rec = _S_U8.unpack(recid)[0]
+    prefix = _S_U8.pack(27 + 4 + rec)
 
     sig = b""
     sig += prefix
@@ -303,16 +331,22 @@ class COutPoint(object):
     def __init__(self, hash=0, n=0xFFFFFFFF):
         self.hash = hash
         self.n = n
+        # The serialization is cached along with the (hash, n) it was computed for, as
+        # it is needed for every sighash of the transaction.
+        self._ser = None
+        self._ser_key = None
 
     def deserialize(self, f):
-        self.hash = deser_uint256(f)
-        self.n = struct.unpack("<I", f.read(4))[0]
+        self._ser = f.read(36)
+        self.hash = uint256_from_str(self._ser)
+        self.n = _S_U32.unpack_from(self._ser, 32)[0]
+        self._ser_key = (self.hash, self.n)
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        if self._ser_key != (self.hash, self.n):
+            self._ser = ser_uint256(self.hash) + _S_U32.pack(self.n)
+            self._ser_key = (self.hash, self.n)
+        return self._ser
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
@@ -331,14 +365,13 @@ class CTxIn(object):
         self.prevout = COutPoint()
         self.prevout.deserialize(f)
         self.scriptSig = deser_string(f)
-        self.nSequence = struct.unpack("<I", f.read(4))[0]
+        self.nSequence = _S_U32.unpack(f.read(4))[0]
 
     def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
+        r = bytearray(self.prevout.serialize())
         r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+        r += _S_U32.pack(self.nSequence)
+        return bytes(r)
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" % (
@@ -354,14 +387,11 @@ class CTxOut(object):
         self.scriptPubKey = scriptPubKey
 
     def deserialize(self, f):
-        self.nValue = struct.unpack("<q", f.read(8))[0]
+        self.nValue = _S_I64.unpack(f.read(8))[0]
         self.scriptPubKey = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
+        return _S_I64.pack(self.nValue) + ser_string(self.scriptPubKey)
 
     def is_p2sh(self):
         return (
@@ -410,9 +440,7 @@ class CScriptWitness(object):
         )
 
     def is_null(self):
-        if self.stack:
-            return False
-        return True
+        return not self.stack
 
 
 class CTxInWitness(object):
@@ -429,7 +457,7 @@ class CTxInWitness(object):
         return repr(self.scriptWitness)
 
     def is_null(self):
-        return self.scriptWitness.is_null()
+        return not self.scriptWitness.stack
 
 
 class CTxWitness(object):
@@ -441,22 +469,16 @@ class CTxWitness(object):
             self.vtxinwit[i].deserialize(f)
 
     def serialize(self):
-        r = b""
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
-        for x in self.vtxinwit:
-            r += x.serialize()
-        return r
+        return b"".join(x.serialize() for x in self.vtxinwit)
 
     def __repr__(self):
         return "CTxWitness(%s)" % (";".join([repr(x) for x in self.vtxinwit]))
 
     def is_null(self):
-        for x in self.vtxinwit:
-            if not x.is_null():
-                return False
-        return True
+        return not any(x.scriptWitness.stack for x in self.vtxinwit)
 
 
 class CTransaction(object):
@@ -471,19 +493,27 @@ class CTransaction(object):
             self.hash = None
         else:
             self.nVersion = tx.nVersion
-            self.vin = copy.deepcopy(tx.vin)
-            self.vout = copy.deepcopy(tx.vout)
+            # The scripts are immutable bytes, only the containers need to be copied.
+            self.vin = [
+                CTxIn(COutPoint(i.prevout.hash, i.prevout.n), i.scriptSig, i.nSequence)
+                for i in tx.vin
+            ]
+            self.vout = [CTxOut(o.nValue, o.scriptPubKey) for o in tx.vout]
             self.nLockTime = tx.nLockTime
             self.sha256 = tx.sha256
             self.hash = tx.hash
-            self.wit = copy.deepcopy(tx.wit)
+            self.wit = CTxWitness()
+            self.wit.vtxinwit = [
+                CTxInWitness(CScriptWitness(list(w.scriptWitness.stack)))
+                for w in tx.wit.vtxinwit
+            ]
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = _S_I32.unpack(f.read(4))[0]
         self.vin = deser_vector(f, CTxIn)
         flags = 0
         if len(self.vin) == 0:
-            flags = struct.unpack("<B", f.read(1))[0]
+            flags = _S_U8.unpack(f.read(1))[0]
             # Not sure why flags can't be zero, but this
             # matches the implementation in bitcoind
             if flags != 0:
@@ -494,31 +524,29 @@ class CTransaction(object):
         if flags != 0:
             self.wit.vtxinwit = [CTxInWitness() for i in range(len(self.vin))]
             self.wit.deserialize(f)
-        self.nLockTime = struct.unpack("<I", f.read(4))[0]
+        self.nLockTime = _S_U32.unpack(f.read(4))[0]
         self.sha256 = None
         self.hash = None
 
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        r = bytearray(_S_I32.pack(self.nVersion))
+        ser_vector(self.vin, buf=r)
+        ser_vector(self.vout, buf=r)
+        r += _S_U32.pack(self.nLockTime)
+        return bytes(r)
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
         flags = 0
         if not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        r = bytearray(_S_I32.pack(self.nVersion))
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+            ser_vector(dummy, buf=r)
+            r += _S_U8.pack(flags)
+        ser_vector(self.vin, buf=r)
+        ser_vector(self.vout, buf=r)
         if flags & 1:
             if len(self.wit.vtxinwit) != len(self.vin):
                 # vtxinwit must have the same length as vin
@@ -526,8 +554,8 @@ class CTransaction(object):
                 for i in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
             r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        r += _S_U32.pack(self.nLockTime)
+        return bytes(r)
 
     # Regular serialization is without witness -- must explicitly
     # call serialize_with_witness to include witness data.
@@ -548,7 +576,8 @@ class CTransaction(object):
 
         if self.sha256 is None:
             self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = encode(hash256(self.serialize())[::-1], "hex_codec").decode("ascii")
+        # Both are the txid, no need to serialize and hash the transaction again.
+        self.hash = ser_uint256(self.sha256)[::-1].hex()
 
     def txid(self):
         if self.sha256 is None:
@@ -636,25 +665,34 @@ class PSBTMap:
     # as it detects mappings (like bip32 derivations, partial sigs, ..) based on this.
     def deserialize(self, f):
         m = {}
-        while True:
-            k = deser_string(f)
-            if len(k) == 0:
-                break
-            v = deser_string(f)
-            if len(k) == 1:
-                k = k[0]
-                assert k not in m
-                m[k] = v
-            else:
-                typ, k = k[0], k[1:]
-                if typ not in m:
-                    m[typ] = {k: v}
+        # Walk the stream's buffer in place rather than reading each size and each
+        # key and value separately, then advance the stream past the map.
+        off = f.tell()
+        with f.getbuffer() as buf:
+            while True:
+                k_len, off = parse_compact_size(buf, off)
+                if k_len == 0:
+                    break
+                k = bytes(buf[off : off + k_len])
+                v_len, off = parse_compact_size(buf, off + k_len)
+                v = bytes(buf[off : off + v_len])
+                off += v_len
+                assert len(k) == k_len and len(v) == v_len
+                if len(k) == 1:
+                    k = k[0]
+                    assert k not in m
+                    m[k] = v
                 else:
-                    m[typ][k] = v
+                    typ, k = k[0], k[1:]
+                    if typ not in m:
+                        m[typ] = {k: v}
+                    else:
+                        m[typ][k] = v
+        f.seek(off)
         self.map = m
 
     def serialize(self):
-        m = b""
+        m = bytearray()
         for key_type in sorted(self.map):
             psbt_val = self.map[key_type]
             if isinstance(key_type, int) and 0 <= key_type and key_type <= 255:
@@ -662,13 +700,17 @@ class PSBTMap:
             if isinstance(psbt_val, dict):
                 for key_data, val_data in psbt_val.items():
                     k = key_type + key_data
-                    m += ser_compact_size(len(k)) + k
-                    m += ser_compact_size(len(val_data)) + val_data
+                    m += ser_compact_size(len(k))
+                    m += k
+                    m += ser_compact_size(len(val_data))
+                    m += val_data
             else:
-                m += ser_compact_size(len(key_type)) + key_type
-                m += ser_compact_size(len(psbt_val)) + psbt_val
+                m += ser_compact_size(len(key_type))
+                m += key_type
+                m += ser_compact_size(len(psbt_val))
+                m += psbt_val
         m += b"\x00"
-        return m
+        return bytes(m)
 
 
 class PSBT:
@@ -679,12 +721,16 @@ class PSBT:
         self.i = i if i is not None else []
         self.o = o if o is not None else []
         self.tx = None
+        # The unsigned transaction last parsed from the global map, and its number of
+        # inputs and outputs. The parsed self.tx may be modified afterward.
+        self._unsigned_tx = (None, None, None)
 
     def deserialize(self, f):
         assert f.read(5) == b"psbt\xff"
         self.g = from_binary(PSBTMap, f)
         assert 0 in self.g.map
         self.tx = from_binary(CTransaction, self.g.map[0])
+        self._unsigned_tx = (self.g.map[0], len(self.tx.vin), len(self.tx.vout))
         self.i = [from_binary(PSBTMap, f) for _ in self.tx.vin]
         self.o = [from_binary(PSBTMap, f) for _ in self.tx.vout]
         return self
@@ -694,9 +740,15 @@ class PSBT:
         assert isinstance(self.i, list) and all(isinstance(x, PSBTMap) for x in self.i)
         assert isinstance(self.o, list) and all(isinstance(x, PSBTMap) for x in self.o)
         assert 0 in self.g.map
-        tx = from_binary(CTransaction, self.g.map[0])
-        assert len(tx.vin) == len(self.i)
-        assert len(tx.vout) == len(self.o)
+        # Don't parse the unsigned transaction again if it wasn't replaced since it was.
+        # Check the serialized one, as it is what gets written.
+        tx_ser, n_vin, n_vout = self._unsigned_tx
+        if tx_ser is not self.g.map[0]:
+            tx = from_binary(CTransaction, self.g.map[0])
+            n_vin, n_vout = len(tx.vin), len(tx.vout)
+            self._unsigned_tx = (self.g.map[0], n_vin, n_vout)
+        assert n_vin == len(self.i)
+        assert n_vout == len(self.o)
 
         psbt = [x.serialize() for x in [self.g] + self.i + self.o]
         return b"psbt\xff" + b"".join(psbt)
@@ -719,46 +771,74 @@ class PSBT:
 
 
 # Sighash serializations
-def sighash_all_witness(script_code, psbt, i, acp=False):
+
+# The BIP143 preimage fields before and after the script code.
+_S_SIGHASH_HEAD = struct.Struct("<i32s32s36s")
+_S_SIGHASH_TAIL = struct.Struct("<qI32sI4s")
+
+
+def precompute_bip143(psbt, acp=False):
     """
-    Compute the ALL signature hash of the {psbt} 's input {i}.
+    Compute the hashPrevouts, hashSequence and hashOutputs of the {psbt} 's transaction.
+    Those are shared by the ALL signature hashes of all its inputs.
 
     :param acp: if True, use ALL | ANYONECANPAY behaviour.
     """
     # Calculate hashPrevouts and hashSequence
     if not acp:
-        prevouts_preimage = b""
-        sequence_preimage = b""
-        for inputs in psbt.tx.vin:
-            prevouts_preimage += inputs.prevout.serialize()
-            sequence_preimage += struct.pack("<I", inputs.nSequence)
-        hashPrevouts = hash256(prevouts_preimage)
-        hashSequence = hash256(sequence_preimage)
+        vin = psbt.tx.vin
+        hashPrevouts = hash256(b"".join(txin.prevout.serialize() for txin in vin))
+        hashSequence = hash256(
+            struct.pack(f"<{len(vin)}I", *(txin.nSequence for txin in vin))
+        )
     else:
         hashPrevouts = b"\x00" * 32
         hashSequence = b"\x00" * 32
 
     # Calculate hashOutputs
-    outputs_preimage = b""
-    for output in psbt.tx.vout:
-        outputs_preimage += output.serialize()
-    hashOutputs = hash256(outputs_preimage)
+    hashOutputs = hash256(b"".join(txout.serialize() for txout in psbt.tx.vout))
+
+    return hashPrevouts, hashSequence, hashOutputs
+
+
+def sighash_all_witness(script_code, psbt, i, acp=False, precomp=None):
+    """
+    Compute the ALL signature hash of the {psbt} 's input {i}.
+
+    :param acp: if True, use ALL | ANYONECANPAY behaviour.
+    :param precomp: the result of precompute_bip143 for this {psbt} and {acp}, to avoid
+                    recomputing it when hashing for all the inputs.
+    """
+    if precomp is None:
+        precomp = precompute_bip143(psbt, acp)
+    hashPrevouts, hashSequence, hashOutputs = precomp
 
     sighash_type = b"\x01\x00\x00\x00" if not acp else b"\x81\x00\x00\x00"
 
-    # Make sighash preimage
+    # Make sighash preimage. It is written in place into a buffer of the exact size.
     prev_txo = from_binary(CTxOut, psbt.i[i].map[PSBT_IN_WITNESS_UTXO])
-    preimage = b""
-    preimage += struct.pack("<i", psbt.tx.nVersion)
-    preimage += hashPrevouts
-    preimage += hashSequence
-    preimage += psbt.tx.vin[i].prevout.serialize()
-    preimage += ser_string(script_code)
-    preimage += struct.pack("<q", prev_txo.nValue)
-    preimage += struct.pack("<I", psbt.tx.vin[i].nSequence)
-    preimage += hashOutputs
-    preimage += struct.pack("<I", psbt.tx.nLockTime)
-    preimage += sighash_type
+    txin = psbt.tx.vin[i]
+    script_code = ser_string(script_code)
+    head_len, code_len = _S_SIGHASH_HEAD.size, len(script_code)
+    preimage = bytearray(head_len + code_len + _S_SIGHASH_TAIL.size)
+    _S_SIGHASH_HEAD.pack_into(
+        preimage,
+        0,
+        psbt.tx.nVersion,
+        hashPrevouts,
+        hashSequence,
+        txin.prevout.serialize(),
+    )
+    preimage[head_len : head_len + code_len] = script_code
+    _S_SIGHASH_TAIL.pack_into(
+        preimage,
+        head_len + code_len,
+        prev_txo.nValue,
+        txin.nSequence,
+        hashOutputs,
+        psbt.tx.nLockTime,
+        sighash_type,
+    )
 
     # hash it
     return hash256(preimage)
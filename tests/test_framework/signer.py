@@ -1,11 +1,18 @@
+import atexit
+import functools
 import logging
 import os
 import subprocess
+import threading
+import weakref
 
 from bip32 import BIP32
 from bip32.utils import coincurve
+from concurrent import futures
 from test_framework.serializations import (
     PSBT,
+    deser_der_path,
+    precompute_bip143,
     sighash_all_witness,
     PSBT_IN_BIP32_DERIVATION,
     PSBT_IN_WITNESS_SCRIPT,
@@ -17,6 +24,58 @@ from test_framework.serializations import (
     PSBT_IN_TAP_INTERNAL_KEY,
     PSBT_IN_TAP_MERKLE_ROOT,
 )
+from test_framework.utils import EXECUTOR_WORKERS
+
+# Shared by all the PSBTs to sign, to not start new threads for each of them.
+SIGNING_EXECUTOR = futures.ThreadPoolExecutor(
+    max_workers=EXECUTOR_WORKERS, thread_name_prefix="signer"
+)
+
+
+# Instantiating a coincurve private key computes its public key, so reuse the most
+# recently used ones across the PSBTs signed by a test.
+@functools.lru_cache(maxsize=1024)
+def coincurve_privkey(secret):
+    """Get the coincurve private key for these 32 bytes {secret}."""
+    return coincurve.PrivateKey(secret)
+
+
+# The derivation caches of each BIP32 object, dropped along with it.
+DERIVATION_CACHES = weakref.WeakKeyDictionary()
+
+
+def derivation_cache(hd):
+    """Get the cache of derived keys of this BIP32 object.
+
+    :returns: a tuple of a dict from parent derivation path to BIP32 object and of a
+              dict from derivation path to private key.
+    """
+    if hd not in DERIVATION_CACHES:
+        DERIVATION_CACHES[hd] = ({}, {})
+    return DERIVATION_CACHES[hd]
+
+
+def derive_privkey(hd, der_path, cache):
+    """Derive the private key at the given derivation path.
+
+    The derived keys are memoized in {cache}, and so is the extended private key of
+    their parent so deriving keys for siblings (e.g. consecutive indexes of the same
+    descriptor) only costs a single child derivation each.
+
+    :param hd: the BIP32 object to derive the private key from.
+    :param der_path: the derivation path, as a list of indexes.
+    :param cache: the derivation cache of {hd}, as returned by derivation_cache().
+    :returns: the 32 bytes of the private key.
+    """
+    parents, privkeys = cache
+    path = tuple(der_path)
+    if path not in privkeys:
+        parent_path = path[:-1]
+        if parent_path not in parents:
+            chaincode, privkey = hd.get_extended_privkey_from_path(list(parent_path))
+            parents[parent_path] = BIP32(chaincode, privkey, network=hd.network)
+        privkeys[path] = parents[parent_path].get_privkey_from_path(list(path[-1:]))
+    return privkeys[path]
 
 
 def sign_psbt_wsh(psbt, hds):
@@ -30,51 +89,77 @@ def sign_psbt_wsh(psbt, hds):
     """
     assert isinstance(psbt, PSBT)
 
-    # Sign each input.
-    for i, psbt_in in enumerate(psbt.i):
+    # Deriving the private keys is costly. Inputs spending coins at the same derivation
+    # path are signed for by the same keys, as are successive PSBTs spending the same
+    # coins, so derive them only once per signer.
+    caches = [derivation_cache(hd) for hd in hds]
+
+    # The parts of the sighash preimage committing to the whole transaction are the same
+    # for all inputs.
+    precomp = precompute_bip143(psbt)
+
+    def sign_input(i, psbt_in):
         # First, gather the needed information from the PSBT input.
         # 'hd_keypaths' is of the form {pubkey: (fingerprint (4 bytes), derivation path (n * 4 bytes))}
-        fing_der = next(iter(psbt_in.map[PSBT_IN_BIP32_DERIVATION].values()))
+        derivations = psbt_in.map[PSBT_IN_BIP32_DERIVATION]
+        fing_der = next(iter(derivations.values()))
         raw_der_path = fing_der[4:]
-        der_path = [
-            int.from_bytes(raw_der_path[i : i + 4], byteorder="little", signed=True)
-            for i in range(0, len(raw_der_path), 4)
-        ]
+        der_path = deser_der_path(raw_der_path)
         script_code = psbt_in.map[PSBT_IN_WITNESS_SCRIPT]
+        # The sighash doesn't depend on the signing key.
+        sighash = sighash_all_witness(script_code, psbt, i, precomp=precomp)
+        partial_sigs = psbt_in.map.setdefault(PSBT_IN_PARTIAL_SIG, {})
 
         # Now sign the transaction for all the given keys.
-        for hd in hds:
-            sighash = sighash_all_witness(script_code, psbt, i)
-            privkey = coincurve.PrivateKey(hd.get_privkey_from_path(der_path))
+        for j, hd in enumerate(hds):
+            privkey = coincurve_privkey(derive_privkey(hd, der_path, caches[j]))
             pubkey = privkey.public_key.format()
-            assert pubkey in psbt_in.map[PSBT_IN_BIP32_DERIVATION].keys(), (
+            assert pubkey in derivations, (
                 der_path,
                 fing_der,
                 pubkey,
-                psbt_in.map[PSBT_IN_BIP32_DERIVATION].keys(),
+                derivations.keys(),
             )
             sig = privkey.sign(sighash, hasher=None) + b"\x01"
-            logging.debug(
-                f"Adding signature {sig.hex()} for pubkey {pubkey.hex()} (path {der_path})"
-            )
-            if PSBT_IN_PARTIAL_SIG not in psbt_in.map:
-                psbt_in.map[PSBT_IN_PARTIAL_SIG] = {pubkey: sig}
-            else:
-                psbt_in.map[PSBT_IN_PARTIAL_SIG][pubkey] = sig
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(
+                    f"Adding signature {sig.hex()} for pubkey {pubkey.hex()} (path {der_path})"
+                )
+            partial_sigs[pubkey] = sig
+
+    # Sign each input. Most of the time is spent in libsecp256k1, which releases the
+    # GIL, and the inputs are independent so they can be signed concurrently. Not worth
+    # handing a single input over to another thread though.
+    if len(psbt.i) == 1:
+        sign_input(0, psbt.i[0])
+    else:
+        list(SIGNING_EXECUTOR.map(sign_input, range(len(psbt.i)), psbt.i))
 
     return psbt
 
 
-def sign_psbt_taproot(psbt, hds):
-    """Sign a transaction.
+# The serialized extended private keys of each BIP32 object, dropped along with it.
+XPRIVS = weakref.WeakKeyDictionary()
 
-    This will fill the 'tap_script_sig' / 'tap_key_sig' field of all inputs.
 
-    :param psbt: PSBT of the transaction to be signed.
-    :param hds: the BIP32 objects to sign the transaction with.
-    :returns: PSBT with a signature in each input for the given keys.
+def get_xpriv(hd):
+    """Get the xpriv of this BIP32 object, serializing it only once."""
+    if hd not in XPRIVS:
+        XPRIVS[hd] = hd.get_xpriv()
+    return XPRIVS[hd]
+
+
+# The Taproot signer process, started on first use and reused for all signing requests.
+TAPROOT_SIGNER = None
+TAPROOT_SIGNER_LOCK = threading.Lock()
+
+
+def taproot_signer():
+    """Get the Taproot signer process, (re)starting it if necessary.
+
+    Must be called with TAPROOT_SIGNER_LOCK held.
     """
-    assert isinstance(psbt, PSBT)
+    global TAPROOT_SIGNER
 
     # This file is under tests/test_framework/ and we want tests/tools/taproot_signer/target/release/taproot_signer.
     bin_path = os.path.join(
@@ -90,23 +175,62 @@ def sign_psbt_taproot(psbt, hds):
             "Please compile the Taproot signer under tests/tools using 'cargo bin --release'."
         )
 
-    psbt_str = psbt.to_base64()
-    for hd in hds:
-        xprv = hd.get_xpriv()
-        proc = subprocess.run(
-            [bin_path, psbt_str, xprv], capture_output=True, check=True
+    if TAPROOT_SIGNER is None or TAPROOT_SIGNER.poll() is not None:
+        # Started without arguments, it reads PSBTs and xprivs from stdin.
+        TAPROOT_SIGNER = subprocess.Popen(
+            [bin_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
         )
-        psbt_str = proc.stdout.decode("utf-8")
+    return TAPROOT_SIGNER
+
+
+@atexit.register
+def stop_taproot_signer():
+    """Let the Taproot signer process exit by closing its stdin, if it was started."""
+    if TAPROOT_SIGNER is not None:
+        TAPROOT_SIGNER.stdin.close()
+        TAPROOT_SIGNER.wait()
+
+
+def sign_psbt_taproot(psbt, hds):
+    """Sign a transaction.
+
+    This will fill the 'tap_script_sig' / 'tap_key_sig' field of all inputs.
+
+    :param psbt: PSBT of the transaction to be signed.
+    :param hds: the BIP32 objects to sign the transaction with.
+    :returns: PSBT with a signature in each input for the given keys.
+    """
+    assert isinstance(psbt, PSBT)
+
+    # Have the PSBT signed with all the keys in a single request.
+    xprvs = " ".join(get_xpriv(hd) for hd in hds)
+    with TAPROOT_SIGNER_LOCK:
+        proc = taproot_signer()
+        proc.stdin.write(f"{psbt.to_base64()}\n{xprvs}\n")
+        proc.stdin.flush()
+        psbt_str = proc.stdout.readline().rstrip("\n")
+        if not psbt_str:
+            raise Exception(f"Taproot signer exited with code {proc.wait()}")
 
     return PSBT.from_base64(psbt_str)
 
 
+def random_seeds(count):
+    """Get {count} random 32 bytes seeds out of a single draw from the OS CSPRNG."""
+    entropy = os.urandom(32 * count)
+    return [entropy[i : i + 32] for i in range(0, len(entropy), 32)]
+
+
 class SingleSigner:
     """Assumes a simple 1-primary path 1-recovery path Liana descriptor."""
 
     def __init__(self, is_taproot):
-        self.primary_hd = BIP32.from_seed(os.urandom(32), network="test")
-        self.recovery_hd = BIP32.from_seed(os.urandom(32), network="test")
+        primary_seed, recovery_seed = random_seeds(2)
+        self.primary_hd = BIP32.from_seed(primary_seed, network="test")
+        self.recovery_hd = BIP32.from_seed(recovery_seed, network="test")
         self.is_taproot = is_taproot
 
     def sign_psbt(self, psbt, recovery=False):
@@ -130,14 +254,17 @@ class MultiSigner:
     """A signer that has multiple keys and may have multiple recovery path."""
 
     def __init__(self, primary_hds_count, recovery_hds_counts, is_taproot):
+        seeds = iter(
+            random_seeds(primary_hds_count + sum(recovery_hds_counts.values()))
+        )
         self.prim_hds = [
-            BIP32.from_seed(os.urandom(32), network="test")
+            BIP32.from_seed(next(seeds), network="test")
             for _ in range(primary_hds_count)
         ]
         self.recov_hds = {}
         for timelock, count in recovery_hds_counts.items():
             self.recov_hds[timelock] = [
-                BIP32.from_seed(os.urandom(32), network="test") for _ in range(count)
+                BIP32.from_seed(next(seeds), network="test") for _ in range(count)
             ]
         self.is_taproot = is_taproot
 
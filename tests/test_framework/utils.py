@@ -1,18 +1,35 @@
+import codecs
 import itertools
 import json
 import logging
 import os
 import re
+import selectors
 import socket
 import subprocess
 import threading
 import time
+import weakref
 
 from io import BytesIO
+from operator import itemgetter
 from .serializations import CTransaction, PSBT
 
+try:
+    # Much faster than the standard library on the large responses of some RPC calls.
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+    json_loads = json.loads
+
 TIMEOUT = int(os.getenv("TIMEOUT", 20))
 EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", 5))
+# How many lines of output of each process to keep in memory (and to save in their log
+# file), at least. 0 to keep them all.
+LOG_RING_SIZE = int(os.getenv("LOG_RING_SIZE", 100_000))
 VERBOSE = os.getenv("VERBOSE", "0") == "1"
 LOG_LEVEL = os.getenv("LOG_LEVEL", "debug")
 assert LOG_LEVEL in ["trace", "debug", "info", "warn", "error"]
@@ -48,23 +65,23 @@ def wait_for_while_condition_holds(success, condition, timeout=TIMEOUT, debug_fn
     debug_fn is logged at each call to success, it can be useful for debugging
     when tests fail.
     """
-    start_time = time.time()
+    deadline = time.monotonic() + timeout
     interval = 0.25
     while True:
-        if time.time() >= start_time + timeout:
-            raise ValueError("Error waiting for {}", success)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ValueError("Error waiting for {}".format(success))
         if not condition():
             raise ValueError(
-                "Condition {} not met while waiting for {}", condition, success
+                "Condition {} not met while waiting for {}".format(condition, success)
             )
         if success():
             return
-        if debug_fn is not None:
-            logging.info(debug_fn())
-        time.sleep(interval)
-        interval *= 2
-        if interval > 5:
-            interval = 5
+        # It may be costly (e.g. an RPC call), only call it if its result is logged.
+        if debug_fn is not None and logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("%s", debug_fn())
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 1.5, 0.5)
 
 
 def get_txid(hex_tx):
@@ -97,7 +114,7 @@ def spend_coins(lianad, bitcoind, coins):
     :param coins: a list of dict as returned by listcoins. The coins must all exist.
     :returns: the broadcasted transaction, as hex.
     """
-    total_value = sum(c["amount"] for c in coins)
+    total_value = sum(map(itemgetter("amount"), coins))
     destinations = {
         bitcoind.rpc.getnewaddress(): total_value - 11 - 31 - 300 * len(coins)
     }
@@ -128,6 +145,10 @@ class RpcError(ValueError):
         self.error = error
 
 
+class NoResponseError(ConnectionError):
+    """The connection was closed before any part of the response was read."""
+
+
 class UnixSocket(object):
     """A wrapper for socket.socket that is specialized to unix sockets.
 
@@ -192,6 +213,12 @@ class UnixSocket(object):
 
         return self.sock.recv(length)
 
+    def recv_into(self, buffer) -> int:
+        if self.sock is None:
+            raise socket.error("not connected")
+
+        return self.sock.recv_into(buffer)
+
     def __del__(self) -> None:
         self.close()
 
@@ -200,22 +227,38 @@ class UnixDomainSocketRpc(object):
     def __init__(self, socket_path, logger=logging):
         self.socket_path = socket_path
         self.logger = logger
-        self.next_id = 0
+        self.next_id = itertools.count()
+        # The connection to lianad is kept open for the next calls, one per thread. Note
+        # lianad accepts at most 16 connections (MAX_CONNECTIONS) and stops accepting new
+        # ones past that, so at most this many threads may call a given daemon before it
+        # is stopped. The connections are closed by close().
+        self.local = threading.local()
+        self.socks = weakref.WeakSet()
+        self.socks_lock = threading.Lock()
 
     def _readobj(self, sock):
         """Read a JSON object"""
-        buff = b""
+        # lianad's responses aren't delimited (only the requests are terminated by a
+        # '\n'), but they are JSON objects. Only try to parse what was read once it ends
+        # with a closing brace, instead of after each read, to not parse large responses
+        # over and over.
+        # The response is read directly into a buffer, doubled in size when full.
+        buff = bytearray(2048)
+        n_read = 0
         while True:
-            n_to_read = max(2048, len(buff))
-            chunk = sock.recv(n_to_read)
-            buff += chunk
-            if len(chunk) != n_to_read:
+            if n_read == len(buff):
+                buff.extend(bytes(len(buff)))
+            n = sock.recv_into(memoryview(buff)[n_read:])
+            if n == 0:
+                if n_read == 0:
+                    raise NoResponseError("connection closed without a response")
+                raise socket.error("connection closed before the response was read")
+            n_read += n
+            if buff[n_read - 1] == ord("}"):
                 try:
-                    return json.loads(buff)
+                    return json_loads(buff[:n_read])
                 except json.JSONDecodeError:
-                    # There is more to read, continue
-                    # FIXME: this is a workaround for large reads taken from lianad.
-                    # We should use the '\n' marker instead since lianad uses that.
+                    # It was the end of a nested object, there is more to read.
                     continue
 
     def __getattr__(self, name):
@@ -234,29 +277,70 @@ class UnixDomainSocketRpc(object):
 
         return wrapper
 
+    def _request(self, msg):
+        """Send a request to lianad and read the response.
+
+        The connection of the calling thread is reused if there is one.
+        """
+        try:
+            sock = getattr(self.local, "sock", None)
+            if sock is not None:
+                # The connection may have been closed since the last call (for instance
+                # lianad was restarted). Only send the request again on a new connection
+                # if it can't have been processed: it couldn't be sent or the connection
+                # was closed without any response.
+                try:
+                    sock.sendall(msg)
+                except socket.timeout:
+                    raise
+                except OSError:
+                    sock.close()
+                else:
+                    try:
+                        return self._readobj(sock)
+                    except NoResponseError:
+                        sock.close()
+            sock = self.local.sock = UnixSocket(self.socket_path)
+            with self.socks_lock:
+                self.socks.add(sock)
+            sock.sendall(msg)
+            return self._readobj(sock)
+        except BaseException:
+            # Don't reuse a connection left in an unknown state.
+            if getattr(self.local, "sock", None) is not None:
+                self.local.sock.close()
+            self.local.sock = None
+            raise
+
+    def close(self):
+        """Close the connections of all threads to lianad.
+
+        They are reopened on the next call.
+        """
+        with self.socks_lock:
+            socks, self.socks = list(self.socks), weakref.WeakSet()
+        for sock in socks:
+            sock.close()
+
     def call(self, method, params={}):
         self.logger.debug(f"Calling {method} with params {params}")
 
-        # FIXME: we open a new socket for every readobj call...
-        sock = UnixSocket(self.socket_path)
-        msg = json.dumps(
+        this_id = next(self.next_id)
+        msg = json_dumps(
             {
                 "jsonrpc": "2.0",
-                "id": 0,
+                "id": this_id,
                 "method": method,
                 "params": params,
             }
         )
-        sock.sendall(msg.encode() + b"\n")
-        this_id = self.next_id
-        resp = self._readobj(sock)
+        resp = self._request(msg + b"\n")
 
         self.logger.debug(f"Received response for {method} call: {resp}")
         if "id" in resp and resp["id"] != this_id:
             raise ValueError(
                 "Malformed response, id is not {}: {}.".format(this_id, resp)
             )
-        sock.close()
 
         if not isinstance(resp, dict):
             raise ValueError(
@@ -278,7 +362,10 @@ class TailableProc(object):
 
     def __init__(self, outputDir=None, verbose=True):
         self.logs = []
-        self.logs_cond = threading.Condition(threading.RLock())
+        # The number of lines dropped from the front of self.logs, for the positions
+        # in the logs (such as self.logsearch_start) to remain valid.
+        self.logs_offset = 0
+        self.logs_cond = threading.Condition(threading.Lock())
         self.env = os.environ.copy()
         self.running = False
         self.proc = None
@@ -293,8 +380,9 @@ class TailableProc(object):
         self.verbose = verbose
 
         # A filter function that'll tell us whether to filter out the line (not
-        # pass it to the log matcher and not print it to stdout).
-        self.log_filter = lambda _: False
+        # pass it to the log matcher and not print it to stdout). If None, all the
+        # lines are kept.
+        self.log_filter = None
 
     def start(self, stdin=None, stdout=None, stderr=None):
         """Start the underlying process and start monitoring it."""
@@ -306,17 +394,22 @@ class TailableProc(object):
             stderr=stderr if stderr else subprocess.PIPE,
             env=self.env,
         )
+        # Set it before the tail thread may unset it, if the process exits right away.
+        self.running = True
         self.thread = threading.Thread(target=self.tail)
         self.thread.daemon = True
         self.thread.start()
-        self.running = True
 
     def save_log(self):
         if self.outputDir:
             logpath = os.path.join(self.outputDir, "log")
-            with open(logpath, "w") as f:
-                for l in self.logs:
-                    f.write(l + "\n")
+            with self.logs_cond:
+                logs, n_dropped = self.logs[:], self.logs_offset
+            # Write them all at once rather than line by line.
+            with open(logpath, "w", encoding="utf-8") as f:
+                if n_dropped > 0:
+                    f.write(f"[{n_dropped} earlier lines dropped, see LOG_RING_SIZE]\n")
+                f.write("".join(f"{l}\n" for l in logs))
 
     def stop(self, timeout=10):
         self.save_log()
@@ -340,33 +433,74 @@ class TailableProc(object):
         self.thread.join()
 
     def tail(self):
-        """Tail the stdout of the process and remember it.
+        """Tail the stdout and stderr of the process and remember them.
 
         Stores the lines of output produced by the process in
-        self.logs and signals that a new line was read so that it can
+        self.logs and signals that new lines were read so that they can
         be picked up by consumers.
         """
-        out = self.proc.stdout.readline
-        err = self.proc.stderr.readline
-        for line in itertools.chain(iter(out, ""), iter(err, "")):
-            if len(line) == 0:
-                break
-            if self.log_filter(line.decode("utf-8")):
+        # Read from both pipes as the output comes. Reading stderr only once stdout is
+        # closed could block the process on a full stderr pipe.
+        # Decode the output by chunks rather than by line. The incremental decoders keep
+        # the characters split across two reads.
+        sel = selectors.DefaultSelector()
+        partial_lines, decoders = {}, {}
+        for pipe in (self.proc.stdout, self.proc.stderr):
+            if pipe is not None:
+                sel.register(pipe, selectors.EVENT_READ)
+                partial_lines[pipe] = ""
+                decoders[pipe] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while partial_lines:
+            for key, _ in sel.select():
+                pipe = key.fileobj
+                data = os.read(key.fd, 2**16)
+                text = decoders[pipe].decode(data, final=not data)
+                if data:
+                    *lines, partial_lines[pipe] = (partial_lines[pipe] + text).split(
+                        "\n"
+                    )
+                else:
+                    sel.unregister(pipe)
+                    pipe.close()
+                    last_line = partial_lines.pop(pipe) + text
+                    lines = [last_line] if last_line else []
+                self.append_logs(lines)
+        sel.close()
+
+        # Wake up the log waiters for them to notice the process died.
+        with self.logs_cond:
+            self.running = False
+            self.logs_cond.notify_all()
+
+    def append_logs(self, lines):
+        """Store these lines read from the process' output and signal them."""
+        logs = []
+        log_filter = self.log_filter
+        print_lines = self.verbose and logging.getLogger().isEnabledFor(logging.DEBUG)
+        for line in lines:
+            line = line.rstrip()
+            if log_filter is not None and log_filter(line):
                 continue
-            if self.verbose:
-                logging.debug(f"{self.prefix}: {line.decode().rstrip()}")
+            if print_lines:
+                logging.debug("%s: %s", self.prefix, line)
+            logs.append(line)
+        if logs:
             with self.logs_cond:
-                self.logs.append(str(line.rstrip()))
-                self.logs_cond.notifyAll()
-        self.running = False
-        self.proc.stdout.close()
-        self.proc.stderr.close()
+                self.logs.extend(logs)
+                # Drop the oldest lines by chunks, not to shift the list on every append.
+                if LOG_RING_SIZE and len(self.logs) > LOG_RING_SIZE * 11 // 10:
+                    n_dropped = len(self.logs) - LOG_RING_SIZE
+                    del self.logs[:n_dropped]
+                    self.logs_offset += n_dropped
+                self.logs_cond.notify_all()
 
     def is_in_log(self, regex, start=0):
         """Look for `regex` in the logs."""
 
         ex = re.compile(regex)
-        for l in self.logs[start:]:
+        with self.logs_cond:
+            logs = self.logs[max(0, start - self.logs_offset) :]
+        for l in logs:
             if ex.search(l):
                 logging.debug("Found '%s' in logs", regex)
                 return l
@@ -382,13 +516,21 @@ class TailableProc(object):
         fail if the timeout is exceeded or if the underlying process
         exits before all the `regexs` were found.
 
+        The regexes may be given as strings or as already compiled patterns (without
+        flags), for instance to not compile them anew on each call in a loop.
+
         If timeout is None, no time-out is applied.
         """
         logging.debug("Waiting for {} in the logs".format(regexs))
 
         exs = [re.compile(r) for r in regexs]
+        # Their flags would be lost when combining them below.
+        assert all(r.flags == re.UNICODE for r in exs), "Patterns must not have flags"
         start_time = time.time()
         pos = self.logsearch_start
+        # Search each line for all the remaining regexes at once, and only look for the
+        # one that matched on a hit.
+        combined = re.compile("|".join(f"(?:{r.pattern})" for r in exs))
 
         while True:
             if timeout is not None and time.time() > start_time + timeout:
@@ -399,21 +541,31 @@ class TailableProc(object):
                 raise TimeoutError('Unable to find "{}" in logs.'.format(exs))
 
             with self.logs_cond:
-                if pos >= len(self.logs):
+                # Lines may have been dropped since we last looked.
+                pos = max(pos, self.logs_offset)
+                if pos >= self.logs_offset + len(self.logs):
                     if not self.running:
                         raise ValueError("Process died while waiting for logs")
                     self.logs_cond.wait(1)
                     continue
-
-                for r in exs.copy():
-                    self.logsearch_start = pos + 1
-                    if r.search(self.logs[pos]):
-                        logging.debug("Found '%s' in logs", r)
-                        exs.remove(r)
-                        break
-                if len(exs) == 0:
-                    return self.logs[pos]
-                pos += 1
+                new_lines = self.logs[pos - self.logs_offset :]
+
+            # Only search the new lines once we released the lock, to not block the tail
+            # thread meanwhile.
+            # The position is only advanced once per batch, or up to the last match.
+            for i, line in enumerate(new_lines, pos + 1):
+                if combined.search(line):
+                    for r in exs:
+                        if r.search(line):
+                            logging.debug("Found '%s' in logs", r)
+                            exs.remove(r)
+                            break
+                    if len(exs) == 0:
+                        self.logsearch_start = i
+                        return line
+                    combined = re.compile("|".join(f"(?:{r.pattern})" for r in exs))
+            pos += len(new_lines)
+            self.logsearch_start = pos
 
     def wait_for_log(self, regex, timeout=TIMEOUT):
         """Look for `regex` in the logs.
@@ -1,5 +1,6 @@
 import logging
 import pytest
+import re
 import shutil
 import time
 
@@ -19,25 +20,35 @@ from test_framework.utils import (
 
 from threading import Thread
 
+# The logs of a request to bitcoind failing due to its work queue being full, and retried.
+# No compilation flags: wait_for_logs() combines the patterns into a single regex.
+RE_WORKQUEUE_EXCEEDED = re.compile(
+    r"Transient error when sending request to bitcoind.*(status: 503, body: Work queue depth exceeded)"
+)
+RE_RETRYING_RPC = re.compile(r"Retrying RPC request to bitcoind")
+
 
 def receive_and_send(lianad, bitcoind):
     n_coins = len(lianad.rpc.listcoins()["coins"])
 
-    # Receive 3 coins in different blocks on different addresses.
-    for _ in range(3):
-        addr = lianad.rpc.getnewaddress()["address"]
-        txid = bitcoind.rpc.sendtoaddress(addr, 0.01)
-        bitcoind.generate_block(1, wait_for_mempool=txid)
-    wait_for(lambda: len(lianad.rpc.listcoins()["coins"]) == n_coins + 3)
+    # Receive 3 coins in different blocks on different addresses. Send them all at
+    # once and then mine each of them in its own block.
+    addrs = [lianad.rpc.getnewaddress()["address"] for _ in range(3)]
+    txids = [bitcoind.rpc.sendtoaddress(addr, 0.01) for addr in addrs]
+    mining_addr = bitcoind.rpc.getnewaddress()
+    for txid in txids:
+        bitcoind.rpc.generateblock(mining_addr, [txid])
+    # Keep the coins from the last poll to not query them again right after.
+    coins = []
+
+    def received_coins():
+        coins[:] = lianad.rpc.listcoins()["coins"]
+        return len(coins) == n_coins + 3
+
+    wait_for(received_coins)
 
     # Create a spend that will create a change output, sign and broadcast it.
-    outpoints = [
-        next(
-            c["outpoint"]
-            for c in lianad.rpc.listcoins()["coins"]
-            if c["spend_info"] is None
-        )
-    ]
+    outpoints = [next(c["outpoint"] for c in coins if c["spend_info"] is None)]
     destinations = {
         bitcoind.rpc.getnewaddress(): 200_000,
     }
@@ -200,9 +211,12 @@ def test_multipath(lianad_multipath, bitcoind):
 
 def test_coinbase_deposit(lianad, bitcoind):
     """Check we detect deposits from (mature) coinbase transactions."""
-    wait_for_sync = lambda: wait_for(
-        lambda: lianad.rpc.getinfo()["block_height"] == bitcoind.rpc.getblockcount()
-    )
+
+    def wait_for_sync():
+        # The test is the one mining, the block count of bitcoind won't change meanwhile.
+        height = bitcoind.rpc.getblockcount()
+        wait_for(lambda: lianad.rpc.getinfo()["block_height"] == height)
+
     wait_for_sync()
 
     # Create a new deposit in a coinbase transaction. We must detect it and treat it as immature.
@@ -345,10 +359,7 @@ def test_retry_on_workqueue_exceeded(lianad, bitcoind, executor):
         f_liana = executor.submit(lianad.rpc.getinfo)
         try:
             lianad.wait_for_logs(
-                [
-                    "Transient error when sending request to bitcoind.*(status: 503, body: Work queue depth exceeded)",
-                    "Retrying RPC request to bitcoind",
-                ],
+                [RE_WORKQUEUE_EXCEEDED, RE_RETRYING_RPC],
                 timeout=5,
             )
         except TimeoutError:
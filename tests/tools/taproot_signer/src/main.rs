@@ -1,9 +1,9 @@
-//! A quick and dirty program which reads a PSBT and an xpriv from stdin and outputs the signed
+//! A quick and dirty program which reads a PSBT and xprivs from stdin and outputs the signed
 //! PSBT to stdout. Uses function copied from Liana's hot signer and adapted.
 
 use std::{
     env,
-    io::{self, Write},
+    io::{self, BufRead, Write},
     str::FromStr,
 };
 
@@ -103,17 +103,41 @@ fn sign_psbt(psbt: &mut Psbt, master_xpriv: Xpriv, secp: &secp256k1::Secp256k1<s
     }
 }
 
+fn sign_psbt_str<'a>(
+    psbt_str: &str,
+    xprv_strs: impl IntoIterator<Item = &'a str>,
+    secp: &secp256k1::Secp256k1<secp256k1::All>,
+) -> String {
+    let mut psbt = Psbt::from_str(psbt_str).unwrap();
+    for xprv_str in xprv_strs {
+        let xprv = Xpriv::from_str(xprv_str).unwrap();
+        sign_psbt(&mut psbt, xprv, secp);
+    }
+    psbt.to_string()
+}
+
 fn main() {
     let args: Vec<String> = env::args().collect();
-    assert_eq!(args.len(), 3);
-
-    let mut psbt = Psbt::from_str(&args[1]).unwrap();
-    let xprv = Xpriv::from_str(&args[2]).unwrap();
-
     let secp = secp256k1::Secp256k1::new();
-    sign_psbt(&mut psbt, xprv, &secp);
 
-    let psbt_str = psbt.to_string();
-    print!("{}", psbt_str);
+    // Without arguments, sign PSBTs read from stdin until it's closed. Each is given on a line
+    // followed by a line with the space-separated xprivs to sign it with, and the signed PSBT is
+    // output on a line.
+    if args.len() == 1 {
+        let mut stdout = io::stdout();
+        let mut lines = io::stdin().lock().lines();
+        while let Some(psbt_str) = lines.next() {
+            let psbt_str = psbt_str.unwrap();
+            let xprvs_str = lines.next().expect("Xprivs after each PSBT.").unwrap();
+            let signed_psbt = sign_psbt_str(&psbt_str, xprvs_str.split_whitespace(), &secp);
+            writeln!(stdout, "{}", signed_psbt).unwrap();
+            stdout.flush().unwrap();
+        }
+        return;
+    }
+
+    assert!(args.len() >= 3);
+    let signed_psbt = sign_psbt_str(&args[1], args[2..].iter().map(String::as_str), &secp);
+    print!("{}", signed_psbt);
     io::stdout().flush().unwrap();
 }